@@ -1,5 +1,7 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, EmailStr
 from loguru import logger
 import os
@@ -7,13 +9,19 @@ from dotenv import load_dotenv
 import msal
 from azure.identity import ClientSecretCredential
 from azure.graphrbac import GraphRbacManagementClient
+from msrest.authentication import Authentication
 from typing import Optional, Dict
+import asyncio
+import contextvars
+import heapq
 import json
+import math
 import datetime
 import sys
-import requests
 import threading
 import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 
 # Load environment variables
@@ -25,21 +33,199 @@ logger.add("combined.log", rotation="500 MB", level="INFO")
 
 app = FastAPI(title="MCP Server for M365 Family")
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # M365 configuration
 TENANT_ID = os.getenv("M365_TENANT_ID")
 CLIENT_ID = os.getenv("M365_CLIENT_ID")
 CLIENT_SECRET = os.getenv("M365_CLIENT_SECRET")
 AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
 SCOPE = ["https://graph.microsoft.com/.default"]
+# Token scope of the Azure AD Graph API behind GraphRbacManagementClient
+GRAPH_RBAC_SCOPE = "https://graph.windows.net/.default"
+
+# Additional tenants served by this process, selected with the X-Tenant-Id header
+M365_TENANTS_FILE = os.getenv("M365_TENANTS_FILE")
+M365_POOL_MAX_TENANTS = int(os.getenv("M365_POOL_MAX_TENANTS", "256"))
+# Pooled tenants to warm up, besides the default one, on startup and reload
+M365_PREWARM_TENANTS = int(os.getenv("M365_PREWARM_TENANTS", "0"))
+# Budget (seconds) for building and warming the new clients on POST /api/mcp/reload
+M365_RELOAD_TIMEOUT = float(os.getenv("M365_RELOAD_TIMEOUT", "30"))
+
+# Deadline configuration (seconds). Clients may ask for a different budget with the
+# X-Request-Timeout header, capped at M365_MAX_REQUEST_TIMEOUT.
+M365_REQUEST_TIMEOUT = float(os.getenv("M365_REQUEST_TIMEOUT", "30"))
+M365_MAX_REQUEST_TIMEOUT = float(os.getenv("M365_MAX_REQUEST_TIMEOUT", "120"))
+
+# Absolute time.monotonic() deadline of the request being served, if any
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+# threading.Event set once the request's client has gone or its deadline has passed
+request_cancelled = contextvars.ContextVar("request_cancelled", default=None)
+deadline_exceeded = {"request": 0, "upstream": 0, "disconnected": 0}
+
+def upstream_timeout() -> float:
+    """Seconds left for an upstream call, raising 504 once the budget is spent"""
+    cancelled = request_cancelled.get()
+    if cancelled is not None and cancelled.is_set():
+        raise HTTPException(status_code=504, detail="Request was cancelled")
+    deadline = request_deadline.get()
+    if deadline is None:
+        return M365_REQUEST_TIMEOUT
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        deadline_exceeded["upstream"] += 1
+        raise HTTPException(status_code=504, detail="Request deadline exceeded")
+    return remaining
+
+# Upstream scheduling. Clients pick a class with the X-Priority-Class header.
+M365_UPSTREAM_CONCURRENCY = int(os.getenv("M365_UPSTREAM_CONCURRENCY", "8"))
+M365_PRIORITY_WEIGHTS = os.getenv("M365_PRIORITY_WEIGHTS", "interactive=8,bulk=1")
+M365_DEFAULT_PRIORITY_CLASS = os.getenv("M365_DEFAULT_PRIORITY_CLASS", "interactive")
+# Class used by work the server starts itself (warm-up)
+M365_BACKGROUND_PRIORITY_CLASS = os.getenv("M365_BACKGROUND_PRIORITY_CLASS", "bulk")
+
+def parse_priority_weights(value: str) -> Dict[str, float]:
+    """Parse "name=weight,..." and fail at startup on anything the scheduler cannot use"""
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = float("nan")
+        if not name.strip() or not math.isfinite(weight) or weight <= 0:
+            raise ValueError(f"M365_PRIORITY_WEIGHTS entry {item!r} must be name=positive weight")
+        weights[name.strip()] = weight
+    return weights
+
+M365_PRIORITY_WEIGHTS = parse_priority_weights(M365_PRIORITY_WEIGHTS)
+for setting, value in (
+    ("M365_DEFAULT_PRIORITY_CLASS", M365_DEFAULT_PRIORITY_CLASS),
+    ("M365_BACKGROUND_PRIORITY_CLASS", M365_BACKGROUND_PRIORITY_CLASS)
+):
+    if value not in M365_PRIORITY_WEIGHTS:
+        raise ValueError(f"{setting}={value} is not one of M365_PRIORITY_WEIGHTS {sorted(M365_PRIORITY_WEIGHTS)}")
+if M365_UPSTREAM_CONCURRENCY < 1:
+    raise ValueError("M365_UPSTREAM_CONCURRENCY must be at least 1")
+
+# Priority class of the request being served, if any
+request_priority = contextvars.ContextVar("request_priority", default=None)
+
+class UpstreamScheduler:
+    """Weighted fair queuing of upstream work across priority classes.
+
+    Requests wait here, on the event loop, and only reach the threadpool once they
+    hold one of `concurrency` slots, so a flood of bulk work cannot occupy the
+    threads an interactive request needs. When a slot frees up it goes to the
+    waiting request with the smallest virtual finish time, so each class receives
+    capacity in proportion to its weight.
+    """
+
+    def __init__(self, concurrency: int, weights: Dict[str, float]):
+        self.concurrency = concurrency
+        self.weights = weights
+        self._active = 0
+        self._queue = []
+        self._seq = 0
+        self._virtual_time = 0.0
+        self._last_finish = {name: 0.0 for name in weights}
+        self._wait_times = {name: deque(maxlen=1000) for name in weights}
+        self._service_times = {name: deque(maxlen=1000) for name in weights}
+        self._request_times = {name: deque(maxlen=1000) for name in weights}
+
+    def _dispatch(self):
+        while self._queue and self._active < self.concurrency:
+            finish, _, waiter, _ = heapq.heappop(self._queue)
+            if waiter.done():
+                # Gave up while queued (deadline or client disconnect)
+                continue
+            self._virtual_time = finish
+            self._active += 1
+            waiter.set_result(None)
+
+    def _release(self):
+        self._active -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority_class: str):
+        """Hold one upstream slot for the duration of the block"""
+        # Raises 504 before anything is queued when the budget is already spent
+        timeout = upstream_timeout()
+        queued = time.monotonic()
+        start = max(self._virtual_time, self._last_finish[priority_class])
+        finish = start + 1.0 / self.weights[priority_class]
+        self._last_finish[priority_class] = finish
+        waiter = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._queue, (finish, self._seq, waiter, priority_class))
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as we gave up: hand the slot on
+                self._release()
+            else:
+                # Still queued: make _dispatch skip it
+                waiter.cancel()
+            if not isinstance(e, asyncio.TimeoutError):
+                raise
+            deadline_exceeded["upstream"] += 1
+            raise HTTPException(status_code=504, detail="Request deadline exceeded while queued")
+
+        started = time.monotonic()
+        self._wait_times[priority_class].append(started - queued)
+        try:
+            yield
+        finally:
+            self._service_times[priority_class].append(time.monotonic() - started)
+            self._release()
+
+    def record_request(self, priority_class: str, seconds: float):
+        """Record the end-to-end latency of a request that used upstream capacity"""
+        self._request_times[priority_class].append(seconds)
+
+    @staticmethod
+    def _summary(samples) -> Dict:
+        if not samples:
+            return {"count": 0}
+        ordered = sorted(samples)
+        def percentile(p):
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 2)
+        return {"count": len(ordered), "p50_ms": percentile(0.5), "p99_ms": percentile(0.99)}
+
+    def stats(self) -> Dict:
+        queued = {name: 0 for name in self.weights}
+        for _, _, waiter, priority_class in self._queue:
+            if not waiter.done():
+                queued[priority_class] += 1
+        classes = {
+            name: {
+                "weight": self.weights[name],
+                "queued": queued[name],
+                "request": self._summary(self._request_times[name]),
+                "queue_wait": self._summary(self._wait_times[name]),
+                "upstream": self._summary(self._service_times[name])
+            }
+            for name in self.weights
+        }
+        return {"concurrency": self.concurrency, "active": self._active, "classes": classes}
+
+upstream_scheduler = UpstreamScheduler(M365_UPSTREAM_CONCURRENCY, M365_PRIORITY_WEIGHTS)
+
+# Per-request flags, shared with the middleware that created them
+request_usage = contextvars.ContextVar("request_usage", default=None)
+
+def priority_class() -> str:
+    return request_priority.get() or M365_DEFAULT_PRIORITY_CLASS
+
+async def run_upstream(func, *args):
+    """Run blocking upstream work in the threadpool once the request holds a scheduler slot"""
+    usage = request_usage.get()
+    if usage is not None:
+        usage["upstream"] = True
+    async with upstream_scheduler.slot(priority_class()):
+        return await run_in_threadpool(func, *args)
 
 class PasswordResetRequest(BaseModel):
     user_email: EmailStr
@@ -49,23 +235,58 @@ class PasswordResetRequest(BaseModel):
 class ConfigUpdate(BaseModel):
     config: Dict[str, str]
 
+class CredentialAuthentication(Authentication):
+    """Signs msrest requests with a token from an azure-identity credential"""
+
+    def __init__(self, credential, scope: str = GRAPH_RBAC_SCOPE):
+        super().__init__()
+        self.credential = credential
+        self.scope = scope
+
+    def signed_session(self, session=None):
+        # Called for every request; the credential returns its cached token until it nears expiry.
+        # Skip the token fetch once the request's budget is spent or its client has gone.
+        upstream_timeout()
+        session = super().signed_session(session)
+        session.headers['Authorization'] = f"Bearer {self.credential.get_token(self.scope).token}"
+        return session
+
 class M365API:
-    def __init__(self):
-        self.tenant_id = TENANT_ID
-        self.client_id = CLIENT_ID
-        self.client_secret = CLIENT_SECRET
-        self.authority = AUTHORITY
+    def __init__(self, tenant_id: Optional[str] = None, client_id: Optional[str] = None,
+                 client_secret: Optional[str] = None):
+        self.tenant_id = tenant_id or TENANT_ID
+        self.client_id = client_id or CLIENT_ID
+        self.client_secret = client_secret or CLIENT_SECRET
+        self.authority = f"https://login.microsoftonline.com/{self.tenant_id}"
         self.scope = SCOPE
         self._credential = None
         self._graph_client = None
+        self.warmed = False
         self.base_url = "https://graph.microsoft.com/v1.0"
 
+    def reset_clients(self):
+        """Drop cached credential and Graph client after a configuration change"""
+        self._credential = None
+        self._graph_client = None
+
+    def close(self):
+        """Release the pooled connections held by this tenant's clients"""
+        if self._graph_client:
+            self._graph_client.close()
+        if self._credential:
+            self._credential.close()
+
     def _get_credential(self):
         if not self._credential:
             self._credential = ClientSecretCredential(
                 tenant_id=self.tenant_id,
                 client_id=self.client_id,
-                client_secret=self.client_secret
+                client_secret=self.client_secret,
+                # azure-core waits 300s per attempt by default, plus retries; bound the whole
+                # token fetch so a hung login endpoint cannot outlive the deadline
+                connection_timeout=M365_REQUEST_TIMEOUT,
+                read_timeout=M365_REQUEST_TIMEOUT,
+                timeout=M365_REQUEST_TIMEOUT
             )
         return self._credential
 
@@ -73,46 +294,53 @@ class M365API:
         if not self._graph_client:
             credential = self._get_credential()
             self._graph_client = GraphRbacManagementClient(
-                credential=credential,
+                credentials=CredentialAuthentication(credential),
                 tenant_id=self.tenant_id
             )
         return self._graph_client
 
     async def reset_family_member_password(self, reset_request: PasswordResetRequest):
         try:
-            graph_client = self._get_graph_client()
-            
-            # Get user by email
-            users = list(graph_client.users.list(
-                filter=f"mail eq '{reset_request.user_email}'"
-            ))
-            
-            if not users:
-                raise HTTPException(
-                    status_code=404,
-                    detail=f"User with email {reset_request.user_email} not found"
-                )
-            
-            user = users[0]
-            
-            # Reset password
-            password_profile = {
-                "password": reset_request.new_password,
-                "forceChangePasswordNextSignIn": reset_request.force_change
-            }
-            
-            graph_client.users.update(
-                user.object_id,
-                {"passwordProfile": password_profile}
-            )
-            
-            logger.info(f"Password reset successful for user: {reset_request.user_email}")
-            return {"success": True, "message": "Password reset successful"}
-            
+            # The Graph SDK blocks, so run it off the event loop where the deadline can abandon it
+            return await run_upstream(self._reset_password, reset_request)
+        except HTTPException as he:
+            raise he
         except Exception as e:
             logger.error(f"Error resetting password: {str(e)}")
             raise HTTPException(status_code=500, detail=str(e))
 
+    def _reset_password(self, reset_request: PasswordResetRequest):
+        graph_client = self._get_graph_client()
+
+        # Get user by email
+        users = list(graph_client.users.list(
+            filter=f"mail eq '{reset_request.user_email}'",
+            timeout=upstream_timeout()
+        ))
+
+        if not users:
+            raise HTTPException(
+                status_code=404,
+                detail=f"User with email {reset_request.user_email} not found"
+            )
+
+        user = users[0]
+
+        # Reset password
+        password_profile = {
+            "password": reset_request.new_password,
+            "forceChangePasswordNextSignIn": reset_request.force_change
+        }
+
+        graph_client.users.update(
+            user.object_id,
+            {"passwordProfile": password_profile},
+            timeout=upstream_timeout()
+        )
+
+        logger.info(f"Password reset successful for user: {reset_request.user_email}")
+        return {"success": True, "message": "Password reset successful"}
+
     def update_config(self, config: Dict[str, str]):
         """Update the .env file with new configuration"""
         env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
@@ -138,27 +366,260 @@ class M365API:
         self.tenant_id = config.get('M365_TENANT_ID', self.tenant_id)
         self.client_id = config.get('M365_CLIENT_ID', self.client_id)
         self.client_secret = config.get('M365_CLIENT_SECRET', self.client_secret)
+        self.authority = f"https://login.microsoftonline.com/{self.tenant_id}"
+        self.reset_clients()
 
-    def get_access_token(self):
-        """Get Microsoft Graph API access token"""
+    def _warm_up_clients(self):
+        self._get_graph_client()
+        # Same credential and scope the Graph client signs with, so its first request hits the cache
+        self._get_credential().get_token(GRAPH_RBAC_SCOPE)
+
+    async def warm_up(self) -> bool:
+        """Build the credential and Graph client and fetch their first token ahead of traffic"""
         if not all([self.tenant_id, self.client_id, self.client_secret]):
-            raise HTTPException(status_code=500, detail="M365 configuration is missing")
-
-        token_url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/token"
-        token_data = {
-            'grant_type': 'client_credentials',
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-            'scope': 'https://graph.microsoft.com/.default'
-        }
+            return False
 
-        response = requests.post(token_url, data=token_data)
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail=response.text)
+        # Warm-up traffic must not delay interactive requests on a reload
+        token = request_priority.set(M365_BACKGROUND_PRIORITY_CLASS)
+        started = time.monotonic()
+        try:
+            await run_upstream(self._warm_up_clients)
+        except Exception as e:
+            logger.warning(f"M365 warm-up failed for tenant {self.tenant_id}: {str(e)}")
+            return False
+        finally:
+            request_priority.reset(token)
+        logger.info(f"M365 warm-up for tenant {self.tenant_id} took {time.monotonic() - started:.2f}s")
+        self.warmed = True
+        return True
+
+class M365APIPool:
+    """Keyed pool of M365API instances, one per tenant, evicted least recently used.
+
+    The tenant from M365_TENANT_ID is always served by the default instance. Other
+    tenants must be listed in M365_TENANTS_FILE, a JSON object mapping tenant id to
+    optional client_id/client_secret (the default app registration is used otherwise).
+    """
+
+    def __init__(self, default_api: M365API, tenants_file: Optional[str], max_tenants: int):
+        self.default_api = default_api
+        self.tenants_file = tenants_file
+        self.max_tenants = max_tenants
+        self.tenants: Dict[str, Dict[str, str]] = {}
+        self._instances = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_tenants()
+
+    def load_tenants(self):
+        tenants = {}
+        if self.tenants_file and os.path.exists(self.tenants_file):
+            with open(self.tenants_file, 'r') as f:
+                tenants = json.load(f)
+        with self._lock:
+            self.tenants = tenants
+            for api in self._instances.values():
+                api.close()
+            self._instances.clear()
+        logger.info(f"Loaded {len(tenants)} additional M365 tenants")
+
+    def get(self, tenant_id: Optional[str]) -> M365API:
+        if not tenant_id or tenant_id == self.default_api.tenant_id:
+            return self.default_api
+
+        with self._lock:
+            api = self._instances.get(tenant_id)
+            if api:
+                self._instances.move_to_end(tenant_id)
+                self.hits += 1
+                return api
 
-        return response.json()['access_token']
+            if tenant_id not in self.tenants:
+                raise HTTPException(status_code=404, detail=f"Tenant {tenant_id} is not configured")
+
+            self.misses += 1
+            settings = self.tenants[tenant_id]
+            api = M365API(
+                tenant_id=tenant_id,
+                client_id=settings.get("client_id"),
+                client_secret=settings.get("client_secret")
+            )
+            self._instances[tenant_id] = api
+            while len(self._instances) > self.max_tenants:
+                _, evicted = self._instances.popitem(last=False)
+                evicted.close()
+                self.evictions += 1
+            return api
+
+    async def warm_up(self, tenant_count: int) -> bool:
+        """Warm the default tenant and the first tenant_count configured tenants"""
+        apis = [self.default_api] + [self.get(tenant_id) for tenant_id in list(self.tenants)[:tenant_count]]
+        results = await asyncio.gather(*(api.warm_up() for api in apis))
+        return all(results)
+
+    def close(self):
+        """Close the default instance and every pooled tenant"""
+        with self._lock:
+            for api in self._instances.values():
+                api.close()
+            self._instances.clear()
+        self.default_api.close()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "configured": len(self.tenants),
+                "pooled": len(self._instances),
+                "max_tenants": self.max_tenants,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
 
 m365_api = M365API()
+m365_pool = M365APIPool(m365_api, M365_TENANTS_FILE, M365_POOL_MAX_TENANTS)
+# Reload in progress, if any; the next reload waits for it so reloads apply in order
+reload_task = None
+
+class DeadlineMiddleware:
+    """Give each request a deadline and stop its work once the budget is spent or the client hangs up.
+
+    Written as plain ASGI rather than with @app.middleware so it can watch for
+    http.disconnect without consuming the request body the endpoint still needs.
+    """
+
+    def __init__(self, app, default_timeout: float, max_timeout: float, exempt_paths=()):
+        self.app = app
+        self.default_timeout = default_timeout
+        self.max_timeout = max_timeout
+        self.exempt_paths = set(exempt_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exempt_paths:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        budget = self.default_timeout
+        header = headers.get(b"x-request-timeout")
+        if header is not None:
+            try:
+                budget = float(header.decode())
+            except ValueError:
+                budget = float("nan")
+            if not math.isfinite(budget) or budget <= 0:
+                response = JSONResponse(
+                    status_code=400,
+                    content={"detail": "X-Request-Timeout must be a positive number of seconds"}
+                )
+                return await response(scope, receive, send)
+            budget = min(budget, self.max_timeout)
+
+        cancelled = threading.Event()
+        body_received = asyncio.Event()
+        # Messages the disconnect watcher read before the endpoint asked for them
+        pending = deque()
+        response_started = False
+
+        if scope["method"] in ("GET", "HEAD", "DELETE", "OPTIONS") \
+                and b"content-length" not in headers and b"transfer-encoding" not in headers:
+            body_received.set()
+
+        async def receive_request():
+            message = pending.popleft() if pending else await receive()
+            if message["type"] == "http.disconnect" or not message.get("more_body", False):
+                body_received.set()
+            return message
+
+        async def send_response(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        async def wait_for_disconnect():
+            # Once the endpoint has the whole body the server has nothing left to deliver but a disconnect
+            await body_received.wait()
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                pending.append(message)
+
+        deadline_token = request_deadline.set(time.monotonic() + budget)
+        cancelled_token = request_cancelled.set(cancelled)
+        app_task = asyncio.ensure_future(self.app(scope, receive_request, send_response))
+        disconnect_task = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            done, _ = await asyncio.wait(
+                {app_task, disconnect_task}, timeout=budget, return_when=asyncio.FIRST_COMPLETED
+            )
+            if app_task in done:
+                return app_task.result()
+
+            # Stop queued and not-yet-started upstream calls; running ones end at their own timeout
+            cancelled.set()
+            app_task.cancel()
+            await asyncio.gather(app_task, return_exceptions=True)
+
+            if disconnect_task in done:
+                deadline_exceeded["disconnected"] += 1
+                logger.info(f"Client disconnected, cancelled {scope['method']} {scope['path']}")
+                return
+
+            deadline_exceeded["request"] += 1
+            logger.warning(f"Deadline of {budget}s exceeded for {scope['method']} {scope['path']}")
+            if not response_started:
+                response = JSONResponse(status_code=504, content={"detail": "Request deadline exceeded"})
+                await response(scope, receive, send)
+        finally:
+            disconnect_task.cancel()
+            request_cancelled.reset(cancelled_token)
+            request_deadline.reset(deadline_token)
+
+app.add_middleware(
+    DeadlineMiddleware,
+    default_timeout=M365_REQUEST_TIMEOUT,
+    max_timeout=M365_MAX_REQUEST_TIMEOUT
+)
+
+@app.middleware("http")
+async def assign_priority(request: Request, call_next):
+    """Tag the request with the upstream priority class chosen by the client."""
+    requested_class = request.headers.get("x-priority-class")
+    if requested_class and requested_class not in M365_PRIORITY_WEIGHTS:
+        return JSONResponse(
+            status_code=400,
+            content={"detail": f"Unknown priority class, expected one of {sorted(M365_PRIORITY_WEIGHTS)}"}
+        )
+    token = request_priority.set(requested_class)
+    usage = {"upstream": False}
+    usage_token = request_usage.set(usage)
+    started = time.monotonic()
+    try:
+        return await call_next(request)
+    finally:
+        # Only requests that needed upstream capacity say anything about scheduling
+        if usage["upstream"]:
+            upstream_scheduler.record_request(priority_class(), time.monotonic() - started)
+        request_usage.reset(usage_token)
+        request_priority.reset(token)
+
+# CORS middleware, added last so it is outermost and error responses from the
+# middleware above still carry CORS headers
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+@app.on_event("startup")
+async def warm_up_upstream():
+    # Runs before uvicorn accepts connections, so the first real request finds warm clients
+    await m365_pool.warm_up(M365_PREWARM_TENANTS)
 
 @app.get("/health")
 async def health_check():
@@ -168,14 +629,17 @@ async def health_check():
         "config": {
             "tenant_id": m365_api.tenant_id,
             "client_id": m365_api.client_id,
-            "configured": bool(m365_api.tenant_id and m365_api.client_id and m365_api.client_secret)
+            "configured": bool(m365_api.tenant_id and m365_api.client_id and m365_api.client_secret),
+            "tenants": len(m365_pool.tenants) + 1,
+            "warmed": m365_api.warmed
         }
     }
 
 @app.post("/api/mcp/family/password/reset")
-async def reset_password(reset_request: PasswordResetRequest):
+async def reset_password(reset_request: PasswordResetRequest, x_tenant_id: Optional[str] = Header(None)):
     try:
-        result = await m365_api.reset_family_member_password(reset_request)
+        api = m365_pool.get(x_tenant_id)
+        result = await api.reset_family_member_password(reset_request)
         return result
     except HTTPException as he:
         raise he
@@ -205,27 +669,63 @@ async def update_config(config_update: ConfigUpdate):
         logger.error(f"Error updating configuration: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/mcp/metrics")
+async def get_metrics():
+    return {
+        "deadlines": {
+            "default_timeout": M365_REQUEST_TIMEOUT,
+            "max_timeout": M365_MAX_REQUEST_TIMEOUT,
+            "exceeded": dict(deadline_exceeded)
+        },
+        "scheduler": upstream_scheduler.stats(),
+        "tenants": m365_pool.stats()
+    }
+
+async def apply_reload(previous: Optional[asyncio.Future]) -> bool:
+    """Build and warm clients for the reloaded settings, then swap them in.
+
+    Runs as its own task with its own deadline, so a slow warm-up or a client that
+    stops waiting for the reload response never keeps the new settings from applying.
+    """
+    global TENANT_ID, CLIENT_ID, CLIENT_SECRET, AUTHORITY, m365_api, m365_pool
+    if previous:
+        await asyncio.gather(previous, return_exceptions=True)
+    # The task starts with a copy of the reload request's context; give it its own budget
+    request_deadline.set(time.monotonic() + M365_RELOAD_TIMEOUT)
+    request_cancelled.set(None)
+    request_usage.set(None)
+
+    tenant_id = os.getenv("M365_TENANT_ID")
+    client_id = os.getenv("M365_CLIENT_ID")
+    client_secret = os.getenv("M365_CLIENT_SECRET")
+
+    # Build and warm new clients for every tenant while the current ones keep
+    # serving, then swap them in with a single assignment each
+    new_api = M365API(tenant_id, client_id, client_secret)
+    new_pool = M365APIPool(new_api, M365_TENANTS_FILE, M365_POOL_MAX_TENANTS)
+    warmed = await new_pool.warm_up(M365_PREWARM_TENANTS)
+
+    old_pool = m365_pool
+    TENANT_ID, CLIENT_ID, CLIENT_SECRET = tenant_id, client_id, client_secret
+    AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
+    m365_api, m365_pool = new_api, new_pool
+    # Closed Azure clients cannot be reused, so wait until requests still holding them are past their deadline
+    asyncio.get_running_loop().call_later(M365_MAX_REQUEST_TIMEOUT, old_pool.close)
+    return warmed
+
 @app.post("/api/mcp/reload")
 async def reload_server():
+    global reload_task
     try:
         # Reload environment variables
         load_dotenv(override=True)
-        
-        # Update global variables
-        global TENANT_ID, CLIENT_ID, CLIENT_SECRET, AUTHORITY
-        TENANT_ID = os.getenv("M365_TENANT_ID")
-        CLIENT_ID = os.getenv("M365_CLIENT_ID")
-        CLIENT_SECRET = os.getenv("M365_CLIENT_SECRET")
-        AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
-        
-        # Update M365 API instance with new config
-        m365_api.tenant_id = TENANT_ID
-        m365_api.client_id = CLIENT_ID
-        m365_api.client_secret = CLIENT_SECRET
-        m365_api.authority = AUTHORITY
+
+        reload_task = asyncio.ensure_future(apply_reload(reload_task))
+        # Shielded: if this request times out or its client hangs up, the reload still completes
+        warmed = await asyncio.shield(reload_task)
         
         logger.info("Server reloaded successfully with new configuration")
-        return {"success": True, "message": "Server reloaded successfully"}
+        return {"success": True, "message": "Server reloaded successfully", "warmed": warmed}
     except Exception as e:
         logger.error(f"Error reloading server: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,57 @@
+"""Replay recorded ServiceNow incident events against the local webhook.
+
+Usage:
+    python scripts/replay_webhook.py scripts/sample_events.jsonl
+    python scripts/replay_webhook.py events.jsonl --url http://localhost:3002 --delay 0.5
+
+Each line of the input file is one event body as a ServiceNow business rule
+would post it. The secret is read from SNOW_WEBHOOK_SECRET (.env is loaded).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import requests
+from dotenv import load_dotenv
+
+
+def main():
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Replay incident events against the MCP ServiceNow webhook")
+    parser.add_argument("file", help="JSON lines file with one event per line")
+    parser.add_argument("--url", default="http://localhost:3002", help="Base URL of the ServiceNow MCP server")
+    parser.add_argument("--secret", default=os.getenv("SNOW_WEBHOOK_SECRET"), help="Webhook secret")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds to wait between events")
+    args = parser.parse_args()
+
+    if not args.secret:
+        sys.exit("SNOW_WEBHOOK_SECRET is not set; pass --secret or add it to .env")
+
+    endpoint = f"{args.url.rstrip('/')}/api/mcp/webhook/incident"
+    failures = 0
+    with open(args.file, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            response = requests.post(
+                endpoint,
+                json=event,
+                headers={"X-Webhook-Secret": args.secret},
+                timeout=10
+            )
+            status = "ok" if response.status_code == 200 else f"failed ({response.status_code}: {response.text})"
+            print(f"line {line_number}: {event.get('event')} {event.get('incident', {}).get('number')} {status}")
+            if response.status_code != 200:
+                failures += 1
+            if args.delay:
+                time.sleep(args.delay)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,28 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from loguru import logger
 import os
 from dotenv import load_dotenv
 import requests
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Any, Tuple, Literal
+import asyncio
+import contextvars
+import heapq
+import hmac
 import json
+import math
+import re
 import datetime
 import sys
+import sqlite3
 import threading
 import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 
 # Load environment variables
@@ -22,20 +34,208 @@ logger.add("combined.log", rotation="500 MB", level="INFO")
 
 app = FastAPI(title="MCP Server for ServiceNow")
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # ServiceNow configuration
 SNOW_INSTANCE = os.getenv("SNOW_INSTANCE")
 SNOW_USERNAME = os.getenv("SNOW_USERNAME")
 SNOW_PASSWORD = os.getenv("SNOW_PASSWORD")
 
+# Local incident mirror configuration
+SNOW_MIRROR_ENABLED = os.getenv("SNOW_MIRROR_ENABLED", "false").lower() == "true"
+SNOW_MIRROR_PATH = os.getenv("SNOW_MIRROR_PATH", "incident_mirror.db")
+SNOW_MIRROR_SYNC_INTERVAL = int(os.getenv("SNOW_MIRROR_SYNC_INTERVAL", "60"))
+SNOW_MIRROR_MAX_STALENESS = int(os.getenv("SNOW_MIRROR_MAX_STALENESS", "300"))
+SNOW_MIRROR_PAGE_SIZE = int(os.getenv("SNOW_MIRROR_PAGE_SIZE", "500"))
+# How often to compare sys_ids with ServiceNow to drop deleted incidents (0 disables)
+SNOW_MIRROR_RECONCILE_INTERVAL = int(os.getenv("SNOW_MIRROR_RECONCILE_INTERVAL", "3600"))
+
+# Inbound webhook configuration
+SNOW_WEBHOOK_SECRET = os.getenv("SNOW_WEBHOOK_SECRET")
+SNOW_ACTIVITY_HISTORY_SIZE = int(os.getenv("SNOW_ACTIVITY_HISTORY_SIZE", "1000"))
+
+# Deadline configuration (seconds). Clients may ask for a different budget with the
+# X-Request-Timeout header, capped at SNOW_MAX_REQUEST_TIMEOUT.
+SNOW_REQUEST_TIMEOUT = float(os.getenv("SNOW_REQUEST_TIMEOUT", "30"))
+SNOW_MAX_REQUEST_TIMEOUT = float(os.getenv("SNOW_MAX_REQUEST_TIMEOUT", "120"))
+# Long-lived streams are not subject to the request deadline
+DEADLINE_EXEMPT_PATHS = {"/api/mcp/events"}
+
+# Absolute time.monotonic() deadline of the request being served, if any
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+# threading.Event set once the request's client has gone or its deadline has passed
+request_cancelled = contextvars.ContextVar("request_cancelled", default=None)
+deadline_exceeded = {"request": 0, "upstream": 0, "disconnected": 0}
+
+def upstream_timeout() -> float:
+    """Seconds left for an upstream call, raising 504 once the budget is spent"""
+    cancelled = request_cancelled.get()
+    if cancelled is not None and cancelled.is_set():
+        raise HTTPException(status_code=504, detail="Request was cancelled")
+    deadline = request_deadline.get()
+    if deadline is None:
+        return SNOW_REQUEST_TIMEOUT
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        deadline_exceeded["upstream"] += 1
+        raise HTTPException(status_code=504, detail="Request deadline exceeded")
+    return remaining
+
+# Upstream scheduling. Clients pick a class with the X-Priority-Class header.
+SNOW_UPSTREAM_CONCURRENCY = int(os.getenv("SNOW_UPSTREAM_CONCURRENCY", "8"))
+SNOW_PRIORITY_WEIGHTS = os.getenv("SNOW_PRIORITY_WEIGHTS", "interactive=8,bulk=1")
+SNOW_DEFAULT_PRIORITY_CLASS = os.getenv("SNOW_DEFAULT_PRIORITY_CLASS", "interactive")
+# Class used by work the server starts itself (warm-up, mirror sync)
+SNOW_BACKGROUND_PRIORITY_CLASS = os.getenv("SNOW_BACKGROUND_PRIORITY_CLASS", "bulk")
+
+def parse_priority_weights(value: str) -> Dict[str, float]:
+    """Parse "name=weight,..." and fail at startup on anything the scheduler cannot use"""
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = float("nan")
+        if not name.strip() or not math.isfinite(weight) or weight <= 0:
+            raise ValueError(f"SNOW_PRIORITY_WEIGHTS entry {item!r} must be name=positive weight")
+        weights[name.strip()] = weight
+    return weights
+
+SNOW_PRIORITY_WEIGHTS = parse_priority_weights(SNOW_PRIORITY_WEIGHTS)
+for setting, value in (
+    ("SNOW_DEFAULT_PRIORITY_CLASS", SNOW_DEFAULT_PRIORITY_CLASS),
+    ("SNOW_BACKGROUND_PRIORITY_CLASS", SNOW_BACKGROUND_PRIORITY_CLASS)
+):
+    if value not in SNOW_PRIORITY_WEIGHTS:
+        raise ValueError(f"{setting}={value} is not one of SNOW_PRIORITY_WEIGHTS {sorted(SNOW_PRIORITY_WEIGHTS)}")
+if SNOW_UPSTREAM_CONCURRENCY < 1:
+    raise ValueError("SNOW_UPSTREAM_CONCURRENCY must be at least 1")
+
+# Connections opened to ServiceNow before the server starts serving, and after a reload
+SNOW_WARMUP_CONNECTIONS = int(os.getenv("SNOW_WARMUP_CONNECTIONS", "2"))
+# Budget (seconds) for building and warming the new client on POST /api/mcp/reload
+SNOW_RELOAD_TIMEOUT = float(os.getenv("SNOW_RELOAD_TIMEOUT", "30"))
+
+# Priority class of the request being served, if any
+request_priority = contextvars.ContextVar("request_priority", default=None)
+
+class UpstreamScheduler:
+    """Weighted fair queuing of upstream work across priority classes.
+
+    Requests wait here, on the event loop, and only reach the threadpool once they
+    hold one of `concurrency` slots, so a flood of bulk work cannot occupy the
+    threads an interactive request needs. When a slot frees up it goes to the
+    waiting request with the smallest virtual finish time, so each class receives
+    capacity in proportion to its weight.
+    """
+
+    def __init__(self, concurrency: int, weights: Dict[str, float]):
+        self.concurrency = concurrency
+        self.weights = weights
+        self._active = 0
+        self._queue = []
+        self._seq = 0
+        self._virtual_time = 0.0
+        self._last_finish = {name: 0.0 for name in weights}
+        self._wait_times = {name: deque(maxlen=1000) for name in weights}
+        self._service_times = {name: deque(maxlen=1000) for name in weights}
+        self._request_times = {name: deque(maxlen=1000) for name in weights}
+
+    def _dispatch(self):
+        while self._queue and self._active < self.concurrency:
+            finish, _, waiter, _ = heapq.heappop(self._queue)
+            if waiter.done():
+                # Gave up while queued (deadline or client disconnect)
+                continue
+            self._virtual_time = finish
+            self._active += 1
+            waiter.set_result(None)
+
+    def _release(self):
+        self._active -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority_class: str):
+        """Hold one upstream slot for the duration of the block"""
+        # Raises 504 before anything is queued when the budget is already spent
+        timeout = upstream_timeout()
+        queued = time.monotonic()
+        start = max(self._virtual_time, self._last_finish[priority_class])
+        finish = start + 1.0 / self.weights[priority_class]
+        self._last_finish[priority_class] = finish
+        waiter = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._queue, (finish, self._seq, waiter, priority_class))
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(waiter, timeout=timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as we gave up: hand the slot on
+                self._release()
+            else:
+                # Still queued: make _dispatch skip it
+                waiter.cancel()
+            if not isinstance(e, asyncio.TimeoutError):
+                raise
+            deadline_exceeded["upstream"] += 1
+            raise HTTPException(status_code=504, detail="Request deadline exceeded while queued")
+
+        started = time.monotonic()
+        self._wait_times[priority_class].append(started - queued)
+        try:
+            yield
+        finally:
+            self._service_times[priority_class].append(time.monotonic() - started)
+            self._release()
+
+    def record_request(self, priority_class: str, seconds: float):
+        """Record the end-to-end latency of a request that used upstream capacity"""
+        self._request_times[priority_class].append(seconds)
+
+    @staticmethod
+    def _summary(samples) -> Dict:
+        if not samples:
+            return {"count": 0}
+        ordered = sorted(samples)
+        def percentile(p):
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 2)
+        return {"count": len(ordered), "p50_ms": percentile(0.5), "p99_ms": percentile(0.99)}
+
+    def stats(self) -> Dict:
+        queued = {name: 0 for name in self.weights}
+        for _, _, waiter, priority_class in self._queue:
+            if not waiter.done():
+                queued[priority_class] += 1
+        classes = {
+            name: {
+                "weight": self.weights[name],
+                "queued": queued[name],
+                "request": self._summary(self._request_times[name]),
+                "queue_wait": self._summary(self._wait_times[name]),
+                "upstream": self._summary(self._service_times[name])
+            }
+            for name in self.weights
+        }
+        return {"concurrency": self.concurrency, "active": self._active, "classes": classes}
+
+upstream_scheduler = UpstreamScheduler(SNOW_UPSTREAM_CONCURRENCY, SNOW_PRIORITY_WEIGHTS)
+
+# Per-request flags, shared with the middleware that created them
+request_usage = contextvars.ContextVar("request_usage", default=None)
+
+def priority_class() -> str:
+    return request_priority.get() or SNOW_DEFAULT_PRIORITY_CLASS
+
+async def run_upstream(func, *args):
+    """Run blocking upstream work in the threadpool once the request holds a scheduler slot"""
+    usage = request_usage.get()
+    if usage is not None:
+        usage["upstream"] = True
+    async with upstream_scheduler.slot(priority_class()):
+        return await run_in_threadpool(func, *args)
+
 class IncidentCreate(BaseModel):
     title: str
     description: str
@@ -45,11 +245,49 @@ class IncidentCreate(BaseModel):
 class ConfigUpdate(BaseModel):
     config: Dict[str, str]
 
+class IncidentEvent(BaseModel):
+    event: Literal["created", "updated", "deleted"]
+    incident: Dict[str, Any]
+    event_id: Optional[str] = None
+
+SYS_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+def servicenow_now() -> str:
+    """Current time in ServiceNow's sys_updated_on format (UTC)"""
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
 class ServiceNowAPI:
-    def __init__(self):
-        self.instance = SNOW_INSTANCE
-        self.auth = (SNOW_USERNAME, SNOW_PASSWORD)
+    def __init__(self, instance: Optional[str] = None, username: Optional[str] = None,
+                 password: Optional[str] = None):
+        self.instance = instance or SNOW_INSTANCE
+        self.auth = (username or SNOW_USERNAME, password or SNOW_PASSWORD)
         self.base_url = f"https://{self.instance}/api/now" if self.instance else None
+        self.warmed = False
+        # Keep connections open between calls instead of paying DNS and TLS every time
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(pool_maxsize=max(SNOW_UPSTREAM_CONCURRENCY, SNOW_WARMUP_CONNECTIONS))
+        )
+
+    def close(self):
+        """Close the pooled connections to ServiceNow"""
+        self.session.close()
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request to ServiceNow bounded by the current deadline"""
+        try:
+            return self.session.request(
+                method,
+                url,
+                auth=self.auth,
+                headers={"Content-Type": "application/json"},
+                timeout=upstream_timeout(),
+                **kwargs
+            )
+        except requests.Timeout:
+            deadline_exceeded["upstream"] += 1
+            raise HTTPException(status_code=504, detail="ServiceNow request timed out")
 
     def get_current_config(self) -> Dict[str, str]:
         """Get the current configuration from .env file"""
@@ -110,12 +348,7 @@ class ServiceNowAPI:
             "category": incident_data.category
         }
         
-        response = requests.post(
-            url,
-            auth=self.auth,
-            json=payload,
-            headers={"Content-Type": "application/json"}
-        )
+        response = self._request("POST", url, json=payload)
         
         if response.status_code != 201:
             raise HTTPException(status_code=response.status_code, detail=response.text)
@@ -123,22 +356,523 @@ class ServiceNowAPI:
         return response.json()["result"]
 
     def get_incident(self, incident_id: str):
+        """Get an incident by sys_id or number, the same keys the mirror answers to"""
         if not self.base_url:
             raise HTTPException(status_code=500, detail="ServiceNow configuration is missing")
             
-        url = f"{self.base_url}/table/incident/{incident_id}"
-        response = requests.get(
+        if SYS_ID_PATTERN.fullmatch(incident_id):
+            url = f"{self.base_url}/table/incident/{incident_id}"
+            response = self._request("GET", url)
+
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail=response.text)
+
+            return response.json()["result"]
+
+        # "^" would start another clause of the encoded query
+        if "^" in incident_id:
+            raise HTTPException(status_code=404, detail=f"Incident {incident_id} not found")
+        url = f"{self.base_url}/table/incident"
+        response = self._request("GET", url, params={"sysparm_query": f"number={incident_id}", "sysparm_limit": 1})
+
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+
+        results = response.json()["result"]
+        if not results:
+            raise HTTPException(status_code=404, detail=f"Incident {incident_id} not found")
+        return results[0]
+
+    async def warm_up(self, connections: int) -> bool:
+        """Open pooled connections and check credentials with a few cheap concurrent reads"""
+        if not self.base_url or connections <= 0:
+            return False
+
+        def ping():
+            response = self._request(
+                "GET",
+                f"{self.base_url}/table/incident",
+                params={"sysparm_limit": 1, "sysparm_fields": "sys_id"}
+            )
+            if response.status_code != 200:
+                raise HTTPException(status_code=response.status_code, detail=response.text)
+
+        # Warm-up traffic must not delay interactive requests on a reload
+        token = request_priority.set(SNOW_BACKGROUND_PRIORITY_CLASS)
+        started = time.monotonic()
+        try:
+            # Concurrent pings, so each one opens its own pooled connection
+            results = await asyncio.gather(*(run_upstream(ping) for _ in range(connections)), return_exceptions=True)
+        finally:
+            request_priority.reset(token)
+        errors = [result for result in results if isinstance(result, Exception)]
+
+        if errors:
+            logger.warning(f"ServiceNow warm-up failed for {len(errors)}/{connections} connections: {errors[0]}")
+        else:
+            logger.info(f"ServiceNow warm-up opened {connections} connections in {time.monotonic() - started:.2f}s")
+        self.warmed = not errors
+        return self.warmed
+
+    def list_incidents_after(self, cursor: Optional[Tuple[str, str]], limit: int) -> List[Dict]:
+        """Fetch one page of incidents ordered by (sys_updated_on, sys_id), after the cursor.
+
+        Keyset paging: a record updated mid-sync moves behind the cursor instead of
+        shifting the rows after it, so nothing is skipped.
+        """
+        if not self.base_url:
+            raise HTTPException(status_code=500, detail="ServiceNow configuration is missing")
+
+        query = "ORDERBYsys_updated_on^ORDERBYsys_id"
+        if cursor:
+            updated_on, sys_id = cursor
+            query = f"sys_updated_on>{updated_on}^NQsys_updated_on={updated_on}^sys_id>{sys_id}^{query}"
+
+        # Same parameters as get_incident so mirrored and live records have the same shape
+        url = f"{self.base_url}/table/incident"
+        response = self._request(
+            "GET",
             url,
-            auth=self.auth,
-            headers={"Content-Type": "application/json"}
+            params={
+                "sysparm_query": query,
+                "sysparm_limit": limit
+            }
         )
-        
+
         if response.status_code != 200:
             raise HTTPException(status_code=response.status_code, detail=response.text)
-        
+
         return response.json()["result"]
 
+    def list_incident_ids_after(self, after: Optional[str], limit: int) -> List[str]:
+        """Fetch one page of incident sys_ids in sys_id order, after the given one"""
+        if not self.base_url:
+            raise HTTPException(status_code=500, detail="ServiceNow configuration is missing")
+
+        query = "ORDERBYsys_id"
+        if after:
+            query = f"sys_id>{after}^{query}"
+
+        url = f"{self.base_url}/table/incident"
+        response = self._request(
+            "GET",
+            url,
+            params={
+                "sysparm_query": query,
+                "sysparm_fields": "sys_id",
+                "sysparm_limit": limit
+            }
+        )
+
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=response.text)
+
+        return [record["sys_id"] for record in response.json()["result"]]
+
+class IncidentMirror:
+    """Local SQLite copy of the incident table with full-text search.
+
+    Kept current by incremental sync on a (sys_updated_on, sys_id) cursor, plus a
+    periodic sys_ids comparison that drops incidents deleted in ServiceNow. Reads are
+    only served locally while the last successful sync is within max_staleness.
+    Writes and reads use separate connections so a sync never blocks lookups.
+    """
+
+    SCHEMA_VERSION = 1
+
+    def __init__(self, api: ServiceNowAPI, path: str, page_size: int, max_staleness: int):
+        self.api = api
+        self.path = path
+        self.page_size = page_size
+        self.max_staleness = max_staleness
+        self.last_sync: Optional[float] = None
+        self.last_reconcile: Optional[float] = None
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._init_schema()
+        # WAL lets the read connection see the last committed page while a sync writes the next one
+        self._read_lock = threading.Lock()
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+        self._reader.row_factory = sqlite3.Row
+
+    def _init_schema(self):
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS incident ("
+                "sys_id TEXT PRIMARY KEY, number TEXT, sys_updated_on TEXT, data TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS incident_number ON incident(number)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
+            # Deleted incidents, kept so late updates for them are not applied
+            self._conn.execute("CREATE TABLE IF NOT EXISTS incident_deleted (sys_id TEXT PRIMARY KEY, deleted_on TEXT)")
+
+            # The FTS rows share the incident rowid so updates and deletes never scan the index
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < self.SCHEMA_VERSION:
+                self._conn.execute("DROP TABLE IF EXISTS incident_fts")
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS incident_fts USING fts5(number, short_description, description)"
+            )
+            if version < self.SCHEMA_VERSION:
+                for row in self._conn.execute("SELECT rowid, data FROM incident").fetchall():
+                    self._index(row["rowid"], json.loads(row["data"]))
+                self._conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    def _index(self, rowid: int, record: Dict):
+        self._conn.execute(
+            "INSERT INTO incident_fts (rowid, number, short_description, description) VALUES (?, ?, ?, ?)",
+            (rowid, record.get("number") or "", record.get("short_description") or "",
+             record.get("description") or "")
+        )
+
+    @property
+    def cursor(self) -> Optional[Tuple[str, str]]:
+        """(sys_updated_on, sys_id) of the last record pulled by sync"""
+        with self._read_lock:
+            rows = dict(self._reader.execute(
+                "SELECT key, value FROM sync_state WHERE key IN ('watermark', 'watermark_sys_id')"
+            ).fetchall())
+        if "watermark" not in rows:
+            return None
+        return rows["watermark"], rows.get("watermark_sys_id", "")
+
+    def is_fresh(self) -> bool:
+        return self.last_sync is not None and time.time() - self.last_sync <= self.max_staleness
+
+    def upsert(self, records: List[Dict], advance_watermark: bool = True):
+        """Insert or update incident records and advance the sync cursor.
+
+        A record never replaces a stored copy with a newer sys_updated_on, nor
+        brings back a deleted incident unless it was updated after the deletion, so
+        late webhook events and in-flight sync pages cannot roll data back.
+        """
+        with self._lock, self._conn:
+            for record in records:
+                sys_id = record["sys_id"]
+                updated_on = record.get("sys_updated_on") or ""
+                deleted = self._conn.execute(
+                    "SELECT deleted_on FROM incident_deleted WHERE sys_id = ?", (sys_id,)
+                ).fetchone()
+                if deleted:
+                    if updated_on <= deleted["deleted_on"]:
+                        continue
+                    # Changed after the deletion, so it was restored in ServiceNow
+                    self._conn.execute("DELETE FROM incident_deleted WHERE sys_id = ?", (sys_id,))
+                row = self._conn.execute(
+                    "SELECT rowid, sys_updated_on FROM incident WHERE sys_id = ?", (sys_id,)
+                ).fetchone()
+                if row and row["sys_updated_on"] and updated_on < row["sys_updated_on"]:
+                    continue
+                if row:
+                    self._conn.execute("DELETE FROM incident_fts WHERE rowid = ?", (row["rowid"],))
+                # Upsert in place so the rowid shared with incident_fts stays stable
+                inserted = self._conn.execute(
+                    "INSERT INTO incident (sys_id, number, sys_updated_on, data) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(sys_id) DO UPDATE SET number = excluded.number, "
+                    "sys_updated_on = excluded.sys_updated_on, data = excluded.data",
+                    (sys_id, record.get("number"), record.get("sys_updated_on"), json.dumps(record))
+                )
+                self._index(row["rowid"] if row else inserted.lastrowid, record)
+
+            cursors = [(r["sys_updated_on"], r["sys_id"]) for r in records if r.get("sys_updated_on")]
+            if cursors and advance_watermark:
+                self._conn.executemany(
+                    "INSERT INTO sync_state (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    zip(("watermark", "watermark_sys_id"), max(cursors))
+                )
+
+    async def sync(self) -> int:
+        """Pull every incident changed since the cursor, one page at a time"""
+        # Mirror traffic must never compete with interactive lookups
+        token = request_priority.set(SNOW_BACKGROUND_PRIORITY_CLASS)
+        total = 0
+        try:
+            while True:
+                # Each page is scheduled separately so a long sync never holds a slot for long
+                cursor = await run_in_threadpool(lambda: self.cursor)
+                page = await run_upstream(self.api.list_incidents_after, cursor, self.page_size)
+                await run_in_threadpool(self.upsert, page)
+                total += len(page)
+                if len(page) < self.page_size:
+                    break
+        finally:
+            request_priority.reset(token)
+        self.last_sync = time.time()
+        logger.info(f"Incident mirror synced {total} records (cursor {self.cursor})")
+        return total
+
+    async def reconcile(self) -> int:
+        """Drop mirrored incidents that no longer exist in ServiceNow.
+
+        Sync only returns records that still exist, so deletions that arrive without a
+        webhook are found by comparing sys_ids. Only records mirrored before the pass
+        started are candidates, so anything added meanwhile is kept.
+        """
+        local = await run_in_threadpool(self.sys_ids)
+        token = request_priority.set(SNOW_BACKGROUND_PRIORITY_CLASS)
+        remote = set()
+        after = None
+        try:
+            while True:
+                page = await run_upstream(self.api.list_incident_ids_after, after, self.page_size)
+                remote.update(page)
+                if len(page) < self.page_size:
+                    break
+                after = page[-1]
+        finally:
+            request_priority.reset(token)
+        removed = sorted(local - remote)
+        await run_in_threadpool(self.delete, removed, servicenow_now())
+        self.last_reconcile = time.time()
+        logger.info(f"Incident mirror reconcile removed {len(removed)} deleted records")
+        return len(removed)
+
+    def sys_ids(self) -> set:
+        with self._read_lock:
+            return {row[0] for row in self._reader.execute("SELECT sys_id FROM incident")}
+
+    def delete(self, sys_ids: List[str], deleted_on: Optional[str] = None):
+        """Remove incidents from the mirror.
+
+        Pass deleted_on (a sys_updated_on value) when the incidents were deleted in
+        ServiceNow, so older copies arriving later are rejected by upsert.
+        """
+        with self._lock, self._conn:
+            for sys_id in sys_ids:
+                if deleted_on is not None:
+                    self._conn.execute(
+                        "INSERT INTO incident_deleted (sys_id, deleted_on) VALUES (?, ?) "
+                        "ON CONFLICT(sys_id) DO UPDATE SET deleted_on = MAX(deleted_on, excluded.deleted_on)",
+                        (sys_id, deleted_on)
+                    )
+                row = self._conn.execute("SELECT rowid FROM incident WHERE sys_id = ?", (sys_id,)).fetchone()
+                if row:
+                    self._conn.execute("DELETE FROM incident_fts WHERE rowid = ?", (row["rowid"],))
+                    self._conn.execute("DELETE FROM incident WHERE rowid = ?", (row["rowid"],))
+
+    def get(self, incident_id: str) -> Optional[Dict]:
+        """Look up an incident by sys_id or number"""
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT data FROM incident WHERE sys_id = ? OR number = ? LIMIT 1",
+                (incident_id, incident_id)
+            ).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def search(self, query: str, limit: int = 20) -> List[Dict]:
+        """Full-text search over number, short_description and description"""
+        # Quote each term so user input is never parsed as FTS5 syntax
+        terms = " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+        if not terms:
+            return []
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT incident.data FROM incident_fts "
+                "JOIN incident ON incident.rowid = incident_fts.rowid "
+                "WHERE incident_fts MATCH ? ORDER BY incident_fts.rank LIMIT ?",
+                (terms, limit)
+            ).fetchall()
+        return [json.loads(row["data"]) for row in rows]
+
+    def status(self) -> Dict:
+        with self._read_lock:
+            count = self._reader.execute("SELECT COUNT(*) FROM incident").fetchone()[0]
+        cursor = self.cursor
+        return {
+            "enabled": True,
+            "records": count,
+            "watermark": cursor[0] if cursor else None,
+            "last_sync": datetime.fromtimestamp(self.last_sync).isoformat() if self.last_sync else None,
+            "last_reconcile": datetime.fromtimestamp(self.last_reconcile).isoformat() if self.last_reconcile else None,
+            "fresh": self.is_fresh()
+        }
+
+    async def run_sync_loop(self, interval: int, reconcile_interval: int):
+        while True:
+            try:
+                await self.sync()
+                if reconcile_interval > 0 and (
+                    self.last_reconcile is None or time.time() - self.last_reconcile >= reconcile_interval
+                ):
+                    await self.reconcile()
+            except Exception as e:
+                logger.error(f"Incident mirror sync failed: {str(e)}")
+            await asyncio.sleep(interval)
+
 snow_api = ServiceNowAPI()
+incident_mirror = (
+    IncidentMirror(snow_api, SNOW_MIRROR_PATH, SNOW_MIRROR_PAGE_SIZE, SNOW_MIRROR_MAX_STALENESS)
+    if SNOW_MIRROR_ENABLED else None
+)
+
+mirror_sync_task = None
+# Reload in progress, if any; the next reload waits for it so reloads apply in order
+reload_task = None
+
+# Activities received through the webhook, newest last
+activity_history = deque(maxlen=SNOW_ACTIVITY_HISTORY_SIZE)
+# One queue per connected /api/mcp/events client
+event_subscribers = set()
+
+def publish_activity(activity: Dict):
+    activity_history.append(activity)
+    for queue in event_subscribers:
+        if queue.full():
+            # Slow subscriber: drop its oldest event rather than block the webhook
+            queue.get_nowait()
+        queue.put_nowait(activity)
+
+class DeadlineMiddleware:
+    """Give each request a deadline and stop its work once the budget is spent or the client hangs up.
+
+    Written as plain ASGI rather than with @app.middleware so it can watch for
+    http.disconnect without consuming the request body the endpoint still needs.
+    """
+
+    def __init__(self, app, default_timeout: float, max_timeout: float, exempt_paths=()):
+        self.app = app
+        self.default_timeout = default_timeout
+        self.max_timeout = max_timeout
+        self.exempt_paths = set(exempt_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exempt_paths:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        budget = self.default_timeout
+        header = headers.get(b"x-request-timeout")
+        if header is not None:
+            try:
+                budget = float(header.decode())
+            except ValueError:
+                budget = float("nan")
+            if not math.isfinite(budget) or budget <= 0:
+                response = JSONResponse(
+                    status_code=400,
+                    content={"detail": "X-Request-Timeout must be a positive number of seconds"}
+                )
+                return await response(scope, receive, send)
+            budget = min(budget, self.max_timeout)
+
+        cancelled = threading.Event()
+        body_received = asyncio.Event()
+        # Messages the disconnect watcher read before the endpoint asked for them
+        pending = deque()
+        response_started = False
+
+        if scope["method"] in ("GET", "HEAD", "DELETE", "OPTIONS") \
+                and b"content-length" not in headers and b"transfer-encoding" not in headers:
+            body_received.set()
+
+        async def receive_request():
+            message = pending.popleft() if pending else await receive()
+            if message["type"] == "http.disconnect" or not message.get("more_body", False):
+                body_received.set()
+            return message
+
+        async def send_response(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        async def wait_for_disconnect():
+            # Once the endpoint has the whole body the server has nothing left to deliver but a disconnect
+            await body_received.wait()
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                pending.append(message)
+
+        deadline_token = request_deadline.set(time.monotonic() + budget)
+        cancelled_token = request_cancelled.set(cancelled)
+        app_task = asyncio.ensure_future(self.app(scope, receive_request, send_response))
+        disconnect_task = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            done, _ = await asyncio.wait(
+                {app_task, disconnect_task}, timeout=budget, return_when=asyncio.FIRST_COMPLETED
+            )
+            if app_task in done:
+                return app_task.result()
+
+            # Stop queued and not-yet-started upstream calls; running ones end at their own timeout
+            cancelled.set()
+            app_task.cancel()
+            await asyncio.gather(app_task, return_exceptions=True)
+
+            if disconnect_task in done:
+                deadline_exceeded["disconnected"] += 1
+                logger.info(f"Client disconnected, cancelled {scope['method']} {scope['path']}")
+                return
+
+            deadline_exceeded["request"] += 1
+            logger.warning(f"Deadline of {budget}s exceeded for {scope['method']} {scope['path']}")
+            if not response_started:
+                response = JSONResponse(status_code=504, content={"detail": "Request deadline exceeded"})
+                await response(scope, receive, send)
+        finally:
+            disconnect_task.cancel()
+            request_cancelled.reset(cancelled_token)
+            request_deadline.reset(deadline_token)
+
+app.add_middleware(
+    DeadlineMiddleware,
+    default_timeout=SNOW_REQUEST_TIMEOUT,
+    max_timeout=SNOW_MAX_REQUEST_TIMEOUT,
+    exempt_paths=DEADLINE_EXEMPT_PATHS
+)
+
+@app.middleware("http")
+async def assign_priority(request: Request, call_next):
+    """Tag the request with the upstream priority class chosen by the client."""
+    requested_class = request.headers.get("x-priority-class")
+    if requested_class and requested_class not in SNOW_PRIORITY_WEIGHTS:
+        return JSONResponse(
+            status_code=400,
+            content={"detail": f"Unknown priority class, expected one of {sorted(SNOW_PRIORITY_WEIGHTS)}"}
+        )
+    token = request_priority.set(requested_class)
+    usage = {"upstream": False}
+    usage_token = request_usage.set(usage)
+    started = time.monotonic()
+    try:
+        return await call_next(request)
+    finally:
+        # Only requests that needed upstream capacity say anything about scheduling
+        if usage["upstream"]:
+            upstream_scheduler.record_request(priority_class(), time.monotonic() - started)
+        request_usage.reset(usage_token)
+        request_priority.reset(token)
+
+# CORS middleware, added last so it is outermost and error responses from the
+# middleware above still carry CORS headers
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+@app.on_event("startup")
+async def warm_up_upstream():
+    # Runs before uvicorn accepts connections, so the first real request finds a warm pool
+    await snow_api.warm_up(SNOW_WARMUP_CONNECTIONS)
+
+@app.on_event("startup")
+async def start_incident_mirror():
+    global mirror_sync_task
+    if incident_mirror:
+        # Keep a reference so the task is not garbage collected
+        mirror_sync_task = asyncio.create_task(
+            incident_mirror.run_sync_loop(SNOW_MIRROR_SYNC_INTERVAL, SNOW_MIRROR_RECONCILE_INTERVAL)
+        )
+        logger.info("Incident mirror sync started")
 
 @app.get("/health")
 async def health_check():
@@ -148,7 +882,8 @@ async def health_check():
         "config": {
             "instance": snow_api.instance,
             "username": snow_api.auth[0] if snow_api.auth else None,
-            "configured": bool(snow_api.base_url)
+            "configured": bool(snow_api.base_url),
+            "warmed": snow_api.warmed
         }
     }
 
@@ -174,9 +909,11 @@ async def update_config(config_update: ConfigUpdate):
 @app.post("/api/mcp/incident")
 async def create_incident(incident: IncidentCreate):
     try:
-        result = snow_api.create_incident(incident)
+        result = await run_upstream(snow_api.create_incident, incident)
         logger.info(f"Incident created successfully: {result['sys_id']}")
         return {"success": True, "incidentId": result["sys_id"]}
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error creating incident: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -184,32 +921,173 @@ async def create_incident(incident: IncidentCreate):
 @app.get("/api/mcp/incident/{incident_id}")
 async def get_incident(incident_id: str):
     try:
-        incident = snow_api.get_incident(incident_id)
+        if incident_mirror and incident_mirror.is_fresh():
+            incident = await run_in_threadpool(incident_mirror.get, incident_id)
+            if incident:
+                return incident
+        incident = await run_upstream(snow_api.get_incident, incident_id)
         return incident
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"Error fetching incident: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/mcp/incidents/search")
+async def search_incidents(q: str, limit: int = Query(20, ge=1, le=100)):
+    if not incident_mirror:
+        raise HTTPException(status_code=503, detail="Incident mirror is not enabled")
+    if not incident_mirror.is_fresh():
+        raise HTTPException(status_code=503, detail="Incident mirror is stale")
+    try:
+        return await run_in_threadpool(incident_mirror.search, q, limit)
+    except Exception as e:
+        logger.error(f"Error searching incidents: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/mcp/mirror/status")
+async def mirror_status():
+    if not incident_mirror:
+        return {"enabled": False}
+    return await run_in_threadpool(incident_mirror.status)
+
+@app.post("/api/mcp/mirror/sync")
+async def sync_mirror():
+    if not incident_mirror:
+        raise HTTPException(status_code=503, detail="Incident mirror is not enabled")
+    try:
+        synced = await incident_mirror.sync()
+        return {"success": True, "synced": synced}
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"Error syncing incident mirror: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/mcp/metrics")
+async def get_metrics():
+    return {
+        "deadlines": {
+            "default_timeout": SNOW_REQUEST_TIMEOUT,
+            "max_timeout": SNOW_MAX_REQUEST_TIMEOUT,
+            "exceeded": dict(deadline_exceeded)
+        },
+        "scheduler": upstream_scheduler.stats()
+    }
+
+@app.post("/api/mcp/webhook/incident")
+async def incident_webhook(event: IncidentEvent, x_webhook_secret: Optional[str] = Header(None)):
+    """Receive an incident change event from a ServiceNow business rule."""
+    if not SNOW_WEBHOOK_SECRET:
+        raise HTTPException(status_code=503, detail="Webhook is not configured")
+    # Compare bytes: compare_digest rejects non-ASCII str with a TypeError
+    if not x_webhook_secret or not hmac.compare_digest(x_webhook_secret.encode(), SNOW_WEBHOOK_SECRET.encode()):
+        raise HTTPException(status_code=401, detail="Invalid webhook secret")
+
+    incident = event.incident
+    sys_id = incident.get("sys_id")
+    if not sys_id:
+        raise HTTPException(status_code=422, detail="Incident sys_id is required")
+
+    if incident_mirror:
+        try:
+            if event.event == "deleted":
+                deleted_on = incident.get("sys_updated_on") or servicenow_now()
+                await run_in_threadpool(incident_mirror.delete, [sys_id], deleted_on)
+            elif incident.get("sys_updated_on") and incident.get("number"):
+                # Leave the cursor alone so the next sync still picks up anything missed before this event
+                await run_in_threadpool(incident_mirror.upsert, [incident], False)
+            else:
+                # Partial payload: drop the stale copy so reads fall back to ServiceNow
+                await run_in_threadpool(incident_mirror.delete, [sys_id])
+        except Exception as e:
+            logger.error(f"Error applying webhook event to incident mirror: {str(e)}")
+
+    activity = {
+        "id": event.event_id or f"snow-{uuid.uuid4()}",
+        "timestamp": datetime.now().isoformat(),
+        "type": f"incident_{event.event}",
+        "source": "servicenow",
+        "target": "client",
+        "payload": {
+            "incident_id": incident.get("number") or sys_id,
+            "sys_id": sys_id,
+            "title": incident.get("short_description"),
+            "priority": incident.get("priority"),
+            "status": incident.get("state")
+        },
+        "status": "success"
+    }
+    publish_activity(activity)
+    logger.info(f"Webhook event {event.event} received for incident {activity['payload']['incident_id']}")
+    return {"success": True, "activityId": activity["id"]}
+
+@app.get("/api/mcp/events")
+async def stream_events(request: Request):
+    """Server-sent events stream of incident activities as they arrive."""
+    queue = asyncio.Queue(maxsize=100)
+    event_subscribers.add(queue)
+
+    async def event_stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    activity = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(activity)}\n\n"
+        finally:
+            event_subscribers.discard(queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+async def apply_reload(previous: Optional[asyncio.Future]) -> bool:
+    """Build and warm a client for the reloaded settings, then swap it in.
+
+    Runs as its own task with its own deadline, so a slow warm-up or a client that
+    stops waiting for the reload response never keeps the new settings from applying.
+    """
+    global PORT, SNOW_INSTANCE, SNOW_USERNAME, SNOW_PASSWORD, snow_api
+    if previous:
+        await asyncio.gather(previous, return_exceptions=True)
+    # The task starts with a copy of the reload request's context; give it its own budget
+    request_deadline.set(time.monotonic() + SNOW_RELOAD_TIMEOUT)
+    request_cancelled.set(None)
+    request_usage.set(None)
+
+    instance = os.getenv("SNOW_INSTANCE")
+    username = os.getenv("SNOW_USERNAME")
+    password = os.getenv("SNOW_PASSWORD")
+
+    # Build and warm a new ServiceNow API instance while the current one keeps
+    # serving, then swap it in with a single assignment
+    new_api = ServiceNowAPI(instance, username, password)
+    warmed = await new_api.warm_up(SNOW_WARMUP_CONNECTIONS)
+
+    old_api = snow_api
+    PORT = os.getenv("PORT", "3002")
+    SNOW_INSTANCE, SNOW_USERNAME, SNOW_PASSWORD = instance, username, password
+    snow_api = new_api
+    if incident_mirror:
+        incident_mirror.api = new_api
+    # requests reopens pooled connections on demand, so calls still holding the old client finish normally
+    old_api.close()
+    return warmed
+
 @app.post("/api/mcp/reload")
 async def reload_server():
+    global reload_task
     try:
         # Reload environment variables
         load_dotenv(override=True)
-        
-        # Update global variables
-        global PORT, SNOW_INSTANCE, SNOW_USERNAME, SNOW_PASSWORD
-        PORT = os.getenv("PORT", "3002")
-        SNOW_INSTANCE = os.getenv("SNOW_INSTANCE")
-        SNOW_USERNAME = os.getenv("SNOW_USERNAME")
-        SNOW_PASSWORD = os.getenv("SNOW_PASSWORD")
-        
-        # Update ServiceNow API instance with new config
-        snow_api.instance = SNOW_INSTANCE
-        snow_api.auth = (SNOW_USERNAME, SNOW_PASSWORD)
-        snow_api.base_url = f"https://{SNOW_INSTANCE}/api/now" if SNOW_INSTANCE else None
+
+        reload_task = asyncio.ensure_future(apply_reload(reload_task))
+        # Shielded: if this request times out or its client hangs up, the reload still completes
+        warmed = await asyncio.shield(reload_task)
         
         logger.info("Server reloaded successfully with new configuration")
-        return {"success": True, "message": "Server reloaded successfully"}
+        return {"success": True, "message": "Server reloaded successfully", "warmed": warmed}
     except Exception as e:
         logger.error(f"Error reloading server: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -218,7 +1096,10 @@ async def reload_server():
 async def get_activities():
     """Get all activities from ServiceNow server."""
     try:
-        # For now, return sample activities
+        if activity_history:
+            return list(reversed(activity_history))
+
+        # Nothing received through the webhook yet, return sample activities
         activities = [
             {
                 "id": "snow-1",